@@ -1,8 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import date
+import hashlib
+import hmac
+from types import MappingProxyType
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import random
 import time
 import streamlit.components.v1 as components 
 
@@ -19,9 +28,40 @@ SCOPES = [
     "https://www.googleapis.com/auth/drive",
 ]
 
+# --- 各關卡密碼 ---
+# 密碼不放在程式碼裡，存在 st.secrets 的 [passwords] 區段 (clinical / front / secondary / boss)，
+# 格式為 "<salt hex>$<PBKDF2-SHA256 hex>"，可用下列方式產生：
+#   salt = os.urandom(16)
+#   f"{salt.hex()}${hashlib.pbkdf2_hmac('sha256', pwd.encode(), salt, PASSWORD_ITERATIONS).hex()}"
+PASSWORD_ITERATIONS = 200_000
+
+def reset_password_check(role):
+    """密碼欄內容改變時丟掉先前的驗證結果，下次重新比對"""
+    st.session_state.pop(f"_pwd_ok_{role}", None)
+
+def check_password(entered, role):
+    """與 secrets 中的加鹽摘要以固定時間比對；驗證通過只記一個旗標 (不留明碼)，同一輸入不再重算 PBKDF2"""
+    if not entered:
+        return False
+    ok_key = f"_pwd_ok_{role}"
+    if st.session_state.get(ok_key):
+        return True
+    try:
+        salt_hex, digest_hex = st.secrets["passwords"][role].split("$", 1)
+        salt, expected = bytes.fromhex(salt_hex), bytes.fromhex(digest_hex)
+    except (KeyError, ValueError):
+        st.error("❌ 找不到或無法解析密碼設定！")
+        return False
+    digest = hashlib.pbkdf2_hmac("sha256", entered.encode("utf-8"), salt, PASSWORD_ITERATIONS)
+    if hmac.compare_digest(digest, expected):
+        st.session_state[ok_key] = True
+        return True
+    return False
+
 # --- 1. 連線設定 ---
+@st.cache_resource
 def connect_to_google_sheets():
-    """連線到 Google Sheets"""
+    """連線到 Google Sheets (連線物件跨 rerun 與 session 共用)"""
     spreadsheet_name = "dental_assessment_data" 
     try:
         if "connections" not in st.secrets or "gsheets" not in st.secrets["connections"]:
@@ -33,106 +73,248 @@ def connect_to_google_sheets():
             creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
 
         creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
-        client = gspread.authorize(creds)
+        # 共用連線池 (keep-alive)，免每次重新 TLS 握手；連線層只重試連不上的情況，
+        # 429/5xx 交給下方的應用層重試，避免兩層重試次數相乘
+        session = AuthorizedSession(creds)
+        session.mount("https://", HTTPAdapter(
+            pool_connections=4, pool_maxsize=8,
+            max_retries=Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.5),
+        ))
+        client = gspread.Client(auth=creds, session=session)
         sh = client.open(spreadsheet_name)
         return sh
     except Exception as e:
         st.error(f"連線失敗: {e}")
         st.stop()
 
+@st.cache_resource
+def get_worksheet(_sh, title):
+    try:
+        return _sh.worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        return _sh.add_worksheet(title=title, rows=100, cols=100)
+
 # --- 2. 安全讀取與寫入 ---
-def safe_read_data(worksheet):
-    for i in range(3):
+def _retry_after_seconds(error):
+    """讀取 429 回應的 Retry-After 標頭 (秒)，沒有或無法解析時回傳 0"""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+# 配額用完 (429) 或伺服器暫時錯誤才值得重試；其他錯誤 (權限、範圍錯誤等) 重試也不會成功
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def _is_retryable(error):
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, "status_code", None) in RETRYABLE_STATUS
+    return True
+
+def safe_call(fn, *args, **kwargs):
+    """呼叫 Google Sheets API，失敗時以指數退避加隨機抖動重試 (0.5 秒起跳、上限 16 秒)，並遵守 Retry-After"""
+    delay = 0.5
+    for attempt in range(5):
         try:
-            return worksheet.get_all_records()
-        except Exception as e:
-            time.sleep(1.5)
-            if i == 2:
-                st.error(f"連線繁忙，請稍後再試。({e})")
-                st.stop()
-
-@st.cache_data(ttl=5)
+            return fn(*args, **kwargs)
+        except (gspread.exceptions.APIError, requests.exceptions.RequestException) as e:
+            if attempt == 4 or not _is_retryable(e):
+                raise
+            # 抖動讓同時撞到配額的多個 session 錯開重試時間
+            time.sleep(max(_retry_after_seconds(e), delay + random.uniform(0, delay / 2)))
+            delay = min(delay * 2, 16)
+
+def safe_read_data(worksheet):
+    try:
+        # 一次 values.get 取回整張表 (第 1 列為標題)，不逐列轉 dict
+        return safe_call(worksheet.get_all_values)
+    except Exception as e:
+        st.error(f"連線繁忙，請稍後再試。({e})")
+        st.stop()
+
+# 本程式的每個寫入路徑都會呼叫 clear_data_cache()，TTL 只用來帶入其他 session 的變更
+DATA_TTL = 300
+
+@st.cache_data(ttl=DATA_TTL, show_spinner=False)
 def load_data_from_sheet(_worksheet):
     return safe_read_data(_worksheet)
 
+@st.cache_data(ttl=DATA_TTL, show_spinner=False)
+def get_df_all(_worksheet):
+    """整張表的 DataFrame (含解析好的 _date 欄)，各分頁共用，不必每次 rerun 重建"""
+    values = load_data_from_sheet(_worksheet)
+    df_all = pd.DataFrame(values[1:], columns=values[0]) if values else pd.DataFrame()
+    # 標題重複 (例如資料列比標題列長時補上的空白標題) 只保留第一欄，與 build_header_map 一致
+    df_all = df_all.loc[:, ~df_all.columns.duplicated()]
+    if "日期" in df_all.columns:
+        df_all["_date"] = parse_sheet_dates(df_all["日期"])
+    # 狀態與組別只有少數幾種值，轉成 category 後每次篩選只比對整數代碼
+    for col in ("目前狀態", "初考組別"):
+        if col in df_all.columns:
+            df_all[col] = df_all[col].astype("category")
+    # 各階段總分轉成數值欄 (空白為 NA)，圖表與平均不必每次重新轉型
+    for col in ("自評總分", "初考總分", "覆考總分", "最終總分"):
+        if col in df_all.columns:
+            df_all[col] = pd.to_numeric(df_all[col], errors="coerce").convert_dtypes()
+    return df_all
+
+@st.cache_data(ttl=DATA_TTL, show_spinner=False)
+def get_history_rows(_worksheet):
+    """姓名 → 該員工所有資料列的索引 (依日期排序)，歷史趨勢圖直接取用，免每次整表比對"""
+    df_all = get_df_all(_worksheet)
+    if "姓名" not in df_all.columns or "_date" not in df_all.columns:
+        return {}
+    df_sorted = df_all.sort_values("_date", kind="mergesort")
+    groups = df_sorted.groupby(df_sorted["姓名"].astype(str), sort=False).groups
+    return {name: rows.tolist() for name, rows in groups.items()}
+
+def clear_data_cache():
+    load_data_from_sheet.clear()
+    get_df_all.clear()
+    get_history_rows.clear()
+
 def safe_batch_update(worksheet, updates):
-    for i in range(3):
-        try:
-            worksheet.batch_update(updates)
-            return True
-        except Exception:
-            time.sleep(2)
-    st.error("寫入失敗，請檢查網路或稍後再試。")
-    return False
+    try:
+        # 整批一次送出 (單一 HTTP 請求)，輸入模式統一設在請求層級；用 RAW 避免評語被當成公式解析
+        safe_call(worksheet.batch_update, updates, value_input_option=gspread.utils.ValueInputOption.raw)
+        return True
+    except Exception:
+        st.error("寫入失敗，請檢查網路或稍後再試。")
+        return False
 
 # --- 3. 核心功能：依據標題寫入資料 ---
-def save_data_using_headers(worksheet, data_dict):
-    for attempt in range(3):
-        try:
-            raw_headers = worksheet.row_values(1)
-            existing_headers = [h.strip() for h in raw_headers]
-            
-            if not existing_headers:
-                existing_headers = list(data_dict.keys())
-                worksheet.append_row(existing_headers)
-                raw_headers = existing_headers
-            
-            new_cols = [k for k in data_dict.keys() if k not in existing_headers]
-            if new_cols:
-                worksheet.add_cols(len(new_cols))
-                for i, col_name in enumerate(new_cols):
-                    worksheet.update_cell(1, len(raw_headers) + i + 1, col_name)
-                existing_headers.extend(new_cols)
-                
-            row_values = []
-            for header in existing_headers:
-                val = data_dict.get(header, "")
-                row_values.append(val)
-                
-            worksheet.append_row(row_values)
-            return 
-        except Exception:
-            time.sleep(1.5)
-
-# --- 4. 輔助函數 ---
-def calculate_dynamic_score(record, suffix, ref_suffix="-自評"):
-    items = get_assessment_items()
-    total = 0
-    max_score = 0
-    for item in items:
-        key = f"{item['考核項目']}{suffix}"
-        val = record.get(key, 0)
-        ref_key = f"{item['考核項目']}{ref_suffix}"
-        ref_val = record.get(ref_key, 0)
+def ensure_final_grade_column(worksheet):
+    """舊表沒有【最終考績】欄時補上標題；每個 session 只檢查一次，不在送出時才處理"""
+    if st.session_state.get("_schema_ok"):
+        return
+    data = load_data_from_sheet(worksheet)
+    if not data:
+        return
+    # 與 build_header_map 相同，比對前先去掉標題前後空白
+    headers = [h.strip() for h in data[0]]
+    if "最終考績" not in headers:
+        st.toast("正在新增【最終考績】欄位...", icon="🔧")
+        new_col = len(headers) + 1
+        if new_col > worksheet.col_count:
+            safe_call(worksheet.add_cols, new_col - worksheet.col_count)
+        safe_call(worksheet.update_cell, 1, new_col, "最終考績")
+        clear_data_cache()
+    st.session_state["_schema_ok"] = True
+
+def get_sheet_headers(worksheet, refresh=False):
+    """取得第一列標題，同一個 session 只向 Google Sheets 讀取一次"""
+    headers = st.session_state.get("sheet_headers")
+    if refresh or not headers:
+        headers = [h.strip() for h in worksheet.row_values(1)]
+        st.session_state["sheet_headers"] = headers
+    return headers
+
+def _append_using_headers(worksheet, data_dict):
+    try:
+        existing_headers = get_sheet_headers(worksheet)
+        if existing_headers and any(k not in existing_headers for k in data_dict):
+            # 快取可能已過期，新增欄位前先重新確認標題列
+            existing_headers = get_sheet_headers(worksheet, refresh=True)
         
-        if str(ref_val) == "N/A": continue
-        max_score += 10
+        # 要附加的列集中成一次 append_rows；空表時標題列與資料列一起送出
+        rows_to_append = []
+        if not existing_headers:
+            existing_headers = list(data_dict.keys())
+            rows_to_append.append(existing_headers)
         
-        if str(val) == "N/A": continue
-        try:
-            total += int(float(val))
-        except:
-            total += 0
-    return total, max_score
+        new_cols = [k for k in data_dict.keys() if k not in existing_headers]
+        if new_cols:
+            start_col = len(existing_headers) + 1
+            end_col = start_col + len(new_cols) - 1
+            # 寫入範圍超出表格大小時才需要擴欄
+            if end_col > worksheet.col_count:
+                worksheet.add_cols(end_col - worksheet.col_count)
+            header_range = f"{_a1(1, start_col)}:{_a1(1, end_col)}"
+            worksheet.update(range_name=header_range, values=[new_cols])
+            existing_headers.extend(new_cols)
+        st.session_state["sheet_headers"] = existing_headers
+            
+        rows_to_append.append([data_dict.get(header, "") for header in existing_headers])
+        worksheet.append_rows(rows_to_append, value_input_option=gspread.utils.ValueInputOption.raw)
+    except Exception:
+        # 失敗時標題列可能只寫了一半，重試前丟掉快取重新讀取
+        st.session_state.pop("sheet_headers", None)
+        raise
 
-def normalize_date(date_str):
+def save_data_using_headers(worksheet, data_dict):
     try:
-        d = pd.to_datetime(str(date_str))
-        return d.strftime("%Y-%m-%d")
-    except:
-        return str(date_str).strip()
-
-def find_row_index(all_values, name, assess_date):
-    if not all_values: return None, None
-    df = pd.DataFrame(all_values)
-    target_date = normalize_date(assess_date)
-    df["normalized_date"] = df["日期"].apply(normalize_date)
-    df["clean_name"] = df["姓名"].astype(str).str.strip()
-    target_name = name.strip()
-    match = df.index[(df["clean_name"] == target_name) & (df["normalized_date"] == target_date)].tolist()
-    if match:
-        return match[0] + 2, df 
-    return None, df
+        safe_call(_append_using_headers, worksheet, data_dict)
+        return True
+    except Exception:
+        st.error("寫入失敗，請檢查網路或稍後再試。")
+        return False
+
+# --- 4. 輔助函數 ---
+def calculate_stage_scores(record, suffixes, ref_suffix="-自評"):
+    """一次算出多個階段的 (總分, 滿分)：各階段分數排成 階段×項目 陣列，整批轉數值後逐列加總"""
+    refs = np.array([record.get(col, 0) for col in STAGE_COLS[ref_suffix]], dtype=object)
+    vals = np.array([[record.get(col, 0) for col in STAGE_COLS[suffix]] for suffix in suffixes], dtype=object)
+
+    # 自評為 N/A 的項目不列入滿分；該階段為 N/A 的項目不計分
+    ref_mask = refs != "N/A"
+    val_mask = ref_mask & (vals != "N/A")
+
+    scores = pd.to_numeric(pd.Series(vals.ravel()), errors="coerce").fillna(0).to_numpy().reshape(vals.shape)
+    totals = np.trunc(np.where(val_mask, scores, 0)).sum(axis=1)
+    max_score = int(ref_mask.sum()) * 10
+    return [(int(total), max_score) for total in totals]
+
+def calculate_dynamic_score(record, suffix, ref_suffix="-自評"):
+    return calculate_stage_scores(record, (suffix,), ref_suffix)[0]
+
+def build_header_map(data):
+    """標題 → 欄號 (1 起算) 對照表；標題重複時沿用第一個，與 list.index 相同"""
+    header_to_col = {}
+    for i, h in enumerate(data[0], start=1):
+        header_to_col.setdefault(h.strip(), i)
+    return header_to_col
+
+# 欄號 → 欄位字母查表 (A..GR)，組 A1 範圍時免去每格重算 26 進位
+_COL_LETTERS = [gspread.utils.rowcol_to_a1(1, c)[:-1] for c in range(1, 201)]
+
+def _a1(row, col):
+    if col <= len(_COL_LETTERS):
+        return f"{_COL_LETTERS[col - 1]}{row}"
+    return gspread.utils.rowcol_to_a1(row, col)
+
+def build_row_updates(row_idx, cells):
+    """把同一列要寫入的 {欄號: 值} 合併成 batch_update 範圍；相鄰欄位併成一段，減少範圍數"""
+    updates = []
+    run_start, run_values = None, []
+    for col in sorted(cells):
+        if run_values and col == run_start + len(run_values):
+            run_values.append(cells[col])
+            continue
+        if run_values:
+            updates.append(_row_range_update(row_idx, run_start, run_values))
+        run_start, run_values = col, [cells[col]]
+    if run_values:
+        updates.append(_row_range_update(row_idx, run_start, run_values))
+    return updates
+
+def _row_range_update(row_idx, start_col, values):
+    start = _a1(row_idx, start_col)
+    if len(values) > 1:
+        start += ":" + _a1(row_idx, start_col + len(values) - 1)
+    return {"range": start, "values": [values]}
+
+def parse_sheet_dates(dates):
+    """日期欄轉成 datetime64：先以固定格式整欄解析，格式不符的少數列才逐筆推斷"""
+    parsed = pd.to_datetime(dates, format="%Y-%m-%d", errors="coerce")
+    missed = parsed.isna() & dates.astype(str).str.strip().ne("")
+    if missed.any():
+        parsed[missed] = pd.to_datetime(dates[missed].astype(str), format="mixed", errors="coerce")
+    return parsed
+
+@st.cache_data(max_entries=20)
+def to_csv_bytes(df):
+    """匯出 CSV；以內容為快取鍵，篩選條件沒變時不必每次 rerun 重新序列化"""
+    return df.to_csv(index=False).encode('utf-8-sig')
 
 # --- 5. 計算平均值作為預設值 ---
 def calculate_average_defaults(record):
@@ -154,12 +336,9 @@ def calculate_average_defaults(record):
         name = item['考核項目']
         scores = []
         for s in stages:
-            val = record.get(f"{name}{s}", 0)
-            if str(val) != 'N/A':
-                try:
-                    scores.append(float(val))
-                except:
-                    pass
+            score = to_score(record.get(f"{name}{s}", 0), cast=float)
+            if score is not None:
+                scores.append(score)
         
         if scores:
             avg = int(sum(scores) / len(scores) + 0.5)
@@ -171,35 +350,37 @@ def calculate_average_defaults(record):
     return defaults
 
 # --- 6. 資安與UI優化 ---
+# 浮水印與防複製樣式為固定內容，只有浮水印文字隨使用者與時間變動
+_WATERMARK_CSS = """
+<style>
+div.stApp {
+    user-select: none; 
+    -webkit-user-select: none;
+}
+input, textarea {
+    user-select: text !important;
+    -webkit-user-select: text !important;
+}
+.watermark {
+    position: fixed;
+    bottom: 10px;
+    right: 10px;
+    font-size: 12px;
+    color: rgba(150, 150, 150, 0.4);
+    z-index: 9999;
+    pointer-events: none;
+    font-family: sans-serif;
+}
+</style>
+"""
+
+def inject_page_styles():
+    """整頁共用的樣式，每次執行只注入一次 (不隨各分頁重複送出)"""
+    st.html(_WATERMARK_CSS)
+
 def add_security_watermark(username):
     timestamp = pd.Timestamp.now().strftime("%Y-%m-%d %H:%M")
-    css = f"""
-    <style>
-    div.stApp {{
-        user-select: none; 
-        -webkit-user-select: none;
-    }}
-    input, textarea {{
-        user-select: text !important;
-        -webkit-user-select: text !important;
-    }}
-    .watermark {{
-        position: fixed;
-        bottom: 10px;
-        right: 10px;
-        font-size: 12px;
-        color: rgba(150, 150, 150, 0.4);
-        z-index: 9999;
-        pointer-events: none;
-        font-family: sans-serif;
-    }}
-    </style>
-    <script>
-    document.addEventListener('contextmenu', event => event.preventDefault());
-    </script>
-    <div class="watermark">日沐‧勤美‧小日子 內部機密 | {username} | {timestamp} | 禁止外流</div>
-    """
-    st.markdown(css, unsafe_allow_html=True)
+    st.html(f'<div class="watermark">日沐‧勤美‧小日子 內部機密 | {username} | {timestamp} | 禁止外流</div>')
 
 # 檢查是否需要置頂
 def check_and_scroll():
@@ -223,67 +404,95 @@ def show_completion_screen(title, message, unique_key):
     st.markdown("---")
     st.info("💡 為了資訊安全，考核內容已隱藏。如需修改或查詢，請聯繫管理單位。")
     if st.button("🔄 返回首頁 / 填寫下一筆", key=unique_key):
-        for key in list(st.session_state.keys()):
-            if key.startswith("submitted_"):
-                del st.session_state[key]
+        for s in STAGES:
+            st.session_state[f"submitted_{s}"] = False
         st.session_state.need_scroll = True 
         st.rerun()
 
+STAGES = ("self", "clinical", "front", "sec", "boss")
+
 def init_session_state():
-    keys = [
-        "key_counter_self", "key_counter_clinical", "key_counter_front", 
-        "key_counter_sec", "key_counter_boss",
-        "submitted_self", "submitted_clinical", "submitted_front", 
-        "submitted_sec", "submitted_boss",
-        "need_scroll"
-    ]
-    for k in keys:
-        if k not in st.session_state:
-            st.session_state[k] = 0 if "counter" in k else False
+    # 每個 session 只初始化一次；之後的 rerun 看到標記就直接返回
+    if st.session_state.get("_state_init"):
+        return
+    st.session_state.update({
+        **{f"key_counter_{s}": 0 for s in STAGES},
+        **{f"submitted_{s}": False for s in STAGES},
+        "need_scroll": False,
+        "_state_init": True,
+    })
+
+# 評分標準與職能定義為固定內容
+_GUIDE_SCORES_MD = """
+* **10分 (表現卓越)**：超越要求，表現卓越。
+* **8-9分 (完全符合)**：完全符合基本要求，表現穩定。
+* **5-7分 (部分符合)**：部分符合，但有建議改善事項。
+* **3-4分 (不符合)**：不符合，首次列入改善追蹤。
+* **0-2分 (多次不符合)**：多次不符合，需持續改善追蹤。
+* **N/A (不適用)**：此項目不列入考核。
+"""
+
+_GUIDE_DEFS_MD = """
+### 1. 專業技能
+* **跟診/櫃台**：具備職務所需的各項專業知識與技能，能充份滿足工作需求。
+### 2. 核心職能
+* **勤務配合**：遵循規範，維持良好的出勤紀律，並能在工作中展現積極的態度與持續進取的企圖心。
+* **人際協作**：與同儕保持良好互動，尊重並服從上下級指示，具備良好的團隊合作能力。
+### 3. 行政職能
+* **基礎行政**：具備確保診所日常營運穩定的專業能力，能完成行政與支援工作，並有效執行主管交辦任務。
+* **應變與支援**：同時具備高度應變與問題解決能力，能即時處理突發需求，主動支援並展現團隊合作精神。
+"""
 
 def show_guidelines():
     st.error("⚠️ 本考核表內容屬診所機密，嚴禁翻拍外流")
     with st.expander("📖 查看評分標準與職能定義說明", expanded=False):
         tab_a, tab_b = st.tabs(["📊 分數級距定義", "📝 職能定義說明"])
-        with tab_a:
-            st.markdown("""
-            * **10分 (表現卓越)**：超越要求，表現卓越。
-            * **8-9分 (完全符合)**：完全符合基本要求，表現穩定。
-            * **5-7分 (部分符合)**：部分符合，但有建議改善事項。
-            * **3-4分 (不符合)**：不符合，首次列入改善追蹤。
-            * **0-2分 (多次不符合)**：多次不符合，需持續改善追蹤。
-            * **N/A (不適用)**：此項目不列入考核。
-            """)
-        with tab_b:
-            st.markdown("""
-            ### 1. 專業技能
-            * **跟診/櫃台**：具備職務所需的各項專業知識與技能，能充份滿足工作需求。
-            ### 2. 核心職能
-            * **勤務配合**：遵循規範，維持良好的出勤紀律，並能在工作中展現積極的態度與持續進取的企圖心。
-            * **人際協作**：與同儕保持良好互動，尊重並服從上下級指示，具備良好的團隊合作能力。
-            ### 3. 行政職能
-            * **基礎行政**：具備確保診所日常營運穩定的專業能力，能完成行政與支援工作，並有效執行主管交辦任務。
-            * **應變與支援**：同時具備高度應變與問題解決能力，能即時處理突發需求，主動支援並展現團隊合作精神。
-            """)
+        tab_a.markdown(_GUIDE_SCORES_MD)
+        tab_b.markdown(_GUIDE_DEFS_MD)
+
+# 考核項目為固定內容，載入時建立一次；唯讀對照避免呼叫端意外改到共用資料
+ASSESSMENT_ITEMS = tuple(MappingProxyType(item) for item in [
+    {"類別": "專業技能", "考核項目": "跟診技能", "說明": "跟診：器械與診間準備，依照SOP操作，器械準備熟練，無重大缺失；耗材不足能立即補充。"},
+    {"類別": "專業技能", "考核項目": "櫃台技能", "說明": "櫃台：準確完成約診、報表與櫃檯行政作業，確保資料正確無誤。"},
+    {"類別": "職能表現", "考核項目": "跟診執行", "說明": "跟診：正確執行確保診療不中斷，即時支援醫師需求、維持看診流暢與病患舒適。"},
+    {"類別": "職能表現", "考核項目": "櫃台溝通", "說明": "櫃台：與醫師、病人有良好雙向溝通；正確傳達資訊；態度親切專業。"},
+    {"類別": "職能表現", "考核項目": "勤務配合(職能)", "說明": "遵守出勤與請假規範，配合排班並主動協調上班時段，確保診所營運正常。"},
+    {"類別": "職能表現", "考核項目": "勤務配合(配合)", "說明": "積極參與牙科訓練課程，確實出席並將所學應用於工作。"},
+    {"類別": "職能表現", "考核項目": "人際協作(人際)", "說明": "日常能與同儕互助幫忙。診所高峰期主動支援同事，展現跨站協作，確保流程順暢。"},
+    {"類別": "職能表現", "考核項目": "人際協作(協作)", "說明": "能尊重並聽從前輩指示、保持友好互動，並在帶領新人時展現良好態度與指導能力。"},
+    {"類別": "行政職能", "考核項目": "危機處理", "說明": "危機處理：能即時處理各種突發事件，並主動預防問題再次發生。團隊參與：主動參加診所活動，在需要時幫忙支援，展現參與度與團隊向心力。"},
+    {"類別": "行政職能", "考核項目": "基礎職能", "說明": "基礎職能：能確實完成行政工作，如：維修、牙材、牙模等等，確保診所運作穩定。"},
+    {"類別": "行政職能", "考核項目": "進階職能", "說明": "進階職能：能理解診所及老闆的工作要求，妥善效率完成交辦任務。"},
+    {"類別": "行政職能", "考核項目": "應變能力", "說明": "應變能力：能因應老闆各種臨時需求，展現靈活與隨時投入的態度。"},
+])
 
 def get_assessment_items():
-    return [
-        {"類別": "專業技能", "考核項目": "跟診技能", "說明": "跟診：器械與診間準備，依照SOP操作，器械準備熟練，無重大缺失；耗材不足能立即補充。"},
-        {"類別": "專業技能", "考核項目": "櫃台技能", "說明": "櫃台：準確完成約診、報表與櫃檯行政作業，確保資料正確無誤。"},
-        {"類別": "職能表現", "考核項目": "跟診執行", "說明": "跟診：正確執行確保診療不中斷，即時支援醫師需求、維持看診流暢與病患舒適。"},
-        {"類別": "職能表現", "考核項目": "櫃台溝通", "說明": "櫃台：與醫師、病人有良好雙向溝通；正確傳達資訊；態度親切專業。"},
-        {"類別": "職能表現", "考核項目": "勤務配合(職能)", "說明": "遵守出勤與請假規範，配合排班並主動協調上班時段，確保診所營運正常。"},
-        {"類別": "職能表現", "考核項目": "勤務配合(配合)", "說明": "積極參與牙科訓練課程，確實出席並將所學應用於工作。"},
-        {"類別": "職能表現", "考核項目": "人際協作(人際)", "說明": "日常能與同儕互助幫忙。診所高峰期主動支援同事，展現跨站協作，確保流程順暢。"},
-        {"類別": "職能表現", "考核項目": "人際協作(協作)", "說明": "能尊重並聽從前輩指示、保持友好互動，並在帶領新人時展現良好態度與指導能力。"},
-        {"類別": "行政職能", "考核項目": "危機處理", "說明": "危機處理：能即時處理各種突發事件，並主動預防問題再次發生。團隊參與：主動參加診所活動，在需要時幫忙支援，展現參與度與團隊向心力。"},
-        {"類別": "行政職能", "考核項目": "基礎職能", "說明": "基礎職能：能確實完成行政工作，如：維修、牙材、牙模等等，確保診所運作穩定。"},
-        {"類別": "行政職能", "考核項目": "進階職能", "說明": "進階職能：能理解診所及老闆的工作要求，妥善效率完成交辦任務。"},
-        {"類別": "行政職能", "考核項目": "應變能力", "說明": "應變能力：能因應老闆各種臨時需求，展現靈活與隨時投入的態度。"},
-    ]
-
-SCORE_OPTIONS_FULL = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, "N/A"]
-SCORE_OPTIONS_NUM = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    return ASSESSMENT_ITEMS
+
+ITEM_NAMES = [item["考核項目"] for item in ASSESSMENT_ITEMS]
+# 各階段的分數欄名 (依 ITEM_NAMES 順序)，計分與寫入時直接走訪，不必每次重組字串
+STAGE_COLS = {suffix: [f"{name}{suffix}" for name in ITEM_NAMES] for suffix in ("-自評", "-初考", "-覆考", "-最終")}
+# 詳細成績單的階段欄與對應的分數欄 (依階段排列，每段 ITEM_NAMES 個)
+DETAIL_STAGES = ["自評", "初考", "覆考", "最終"]
+DETAIL_COLS = [col for stage in DETAIL_STAGES for col in STAGE_COLS[f"-{stage}"]]
+
+SCORE_OPTIONS_FULL = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, "N/A")
+SCORE_OPTIONS_NUM = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10)
+SCORE_OPTIONS_NA = ("N/A",)
+
+# 分數查表：選單值與 Sheets 讀回的字串都直接對應整數，N/A 對應 None
+SCORE_INT = {v: v for v in SCORE_OPTIONS_NUM}
+SCORE_INT.update({str(v): v for v in SCORE_OPTIONS_NUM})
+SCORE_INT["N/A"] = None
+
+def to_score(val, cast=int):
+    """查表取得分數；查表以外的值才轉型，N/A 或無法解析時回傳 None"""
+    if val in SCORE_INT:
+        return SCORE_INT[val]
+    try:
+        return cast(float(val))
+    except (TypeError, ValueError, OverflowError):
+        return None
 
 # --- 7. UI 渲染函數 ---
 def render_assessment_in_form(prefix, key_suffix, record=None, readonly_stages=None, is_self_eval=False, default_scores=None):
@@ -291,793 +500,641 @@ def render_assessment_in_form(prefix, key_suffix, record=None, readonly_stages=N
     user_scores = {}
     
     st.markdown("### 📝 詳細評分項目")
+
+    # 歷史分數每題一行，進迴圈前一次組好 (每個階段整欄取出)，迴圈內只負責排版
+    history_lines = [None] * len(items)
+    if record is not None and readonly_stages:
+        stage_tags = []
+        for suffix in readonly_stages:
+            stage_name = suffix.replace("-", "")
+            color = "blue" if "自評" in stage_name else "orange" if "初考" in stage_name else "red"
+            scores = [record.get(col, "-") for col in STAGE_COLS[suffix]]
+            stage_tags.append([f":{color}[{stage_name}: {score}]" for score in scores])
+        history_lines = [" | ".join(tags) for tags in zip(*stage_tags)]
+
+    # 審核模式下各題的自評分數一次取出，決定該題是否鎖定為 N/A
+    self_scores = None
+    if not is_self_eval and record is not None:
+        self_scores = [record.get(col, 0) for col in STAGE_COLS["-自評"]]
     
     for idx, item in enumerate(items):
-        with st.container():
-            c1, c2 = st.columns([3, 2])
-            with c1:
-                st.markdown(f"**{idx+1}. {item['考核項目']}**")
-                st.caption(f"說明：{item['說明']}")
-                if record is not None and readonly_stages:
-                    history_text = []
-                    for suffix in readonly_stages:
-                        stage_name = suffix.replace("-", "") 
-                        score = record.get(f"{item['考核項目']}{suffix}", "-")
-                        color = "blue" if "自評" in stage_name else "orange" if "初考" in stage_name else "red"
-                        history_text.append(f":{color}[{stage_name}: {score}]")
-                    if history_text:
-                        st.markdown(" | ".join(history_text))
-
-            with c2:
-                options = SCORE_OPTIONS_FULL
-                disabled = False
-                current_index = 0
-                
-                if not is_self_eval and record is not None:
-                    self_score = record.get(f"{item['考核項目']}-自評", 0)
+        c1, c2 = st.columns([3, 2])
+        with c1:
+            # 標題、說明與歷史分數合併成單一 markdown，減少每題的元件數
+            lines = [f"**{idx+1}. {item['考核項目']}**", f":gray[說明：{item['說明']}]"]
+            if history_lines[idx]:
+                lines.append(history_lines[idx])
+            st.markdown("  \n".join(lines))
+
+        with c2:
+            options = SCORE_OPTIONS_FULL
+            disabled = False
+            current_index = 0
+            
+            if self_scores is not None:
+                if self_scores[idx] == "N/A":
+                    options = SCORE_OPTIONS_NA
+                    disabled = True
+                    current_index = 0
+                else:
+                    options = SCORE_OPTIONS_NUM
+                    disabled = False
+                    current_index = 0 
                     
-                    if str(self_score) == "N/A":
-                        options = ["N/A"]
-                        disabled = True
-                        current_index = 0
-                    else:
-                        options = SCORE_OPTIONS_NUM
-                        disabled = False
-                        current_index = 0 
-                        
-                        if default_scores and item['考核項目'] in default_scores:
-                            default_val = default_scores[item['考核項目']]
-                            if default_val in options:
-                                current_index = options.index(default_val)
-                
-                score = st.selectbox(
-                    f"評分 ({item['考核項目']})", 
-                    options=options,
-                    index=current_index,
-                    disabled=disabled,
-                    key=f"{prefix}_score_{idx}_{key_suffix}", 
-                    label_visibility="collapsed"
-                )
-                user_scores[item['考核項目']] = score
-            st.divider()
+                    if default_scores and item['考核項目'] in default_scores:
+                        default_val = default_scores[item['考核項目']]
+                        if default_val in options:
+                            current_index = options.index(default_val)
+            
+            score = st.selectbox(
+                f"評分 ({item['考核項目']})", 
+                options=options,
+                index=current_index,
+                disabled=disabled,
+                key=f"{prefix}_score_{idx}_{key_suffix}", 
+                label_visibility="collapsed"
+            )
+            user_scores[item['考核項目']] = score
+        st.divider()
     return user_scores
 
+def apply_reviewer_update(worksheet, row_idx, new_status, total_col, stage_suffix, scores, extra_cells, optional_cells=None):
+    """審核/核決送出共用的寫入：狀態、該階段各項分數與總分，加上 extra_cells (評語、建議等，欄位必須存在)
+    與 optional_cells (簽名等，表上有該欄才寫)，整列一次 batch_update，成功後清除資料快取。
+
+    row_idx 為試算表列號，直接由選取紀錄的索引換算 (record.name + 2，第 1 列為標題)。
+    清快取後呼叫端再讀 get_df_all 即為寫入後的最新資料，並留在快取供接下來的 rerun 沿用。
+    """
+    header_to_col = build_header_map(load_data_from_sheet(worksheet))
+    try:
+        cells = {header_to_col["目前狀態"]: new_status}
+        score_sum_col = header_to_col[total_col]
+        for name, value in extra_cells.items():
+            cells[header_to_col[name]] = value
+    except KeyError as e:
+        st.error(f"欄位錯誤: {e}")
+        return False
+    for name, value in (optional_cells or {}).items():
+        if name in header_to_col:
+            cells[header_to_col[name]] = value
+
+    # 寫入各項分數的同時累加總分，不另外再掃一次
+    total_score = 0
+    for col_name, score in zip(STAGE_COLS[stage_suffix], scores.values()):
+        value = to_score(score)
+        if value is not None:
+            total_score += value
+        if col_name in header_to_col:
+            cells[header_to_col[col_name]] = score
+    cells[score_sum_col] = total_score
+
+    if not safe_batch_update(worksheet, build_row_updates(row_idx, cells)):
+        return False
+    clear_data_cache()
+    return True
+
 def safe_sum_scores_from_dict(score_dict):
     total = 0
     max_score = 0
     for val in score_dict.values():
-        if str(val) == "N/A": continue
-        try:
-            total += int(float(val))
-            max_score += 10
-        except:
-            pass
+        score = to_score(val)
+        if score is None: continue
+        total += score
+        max_score += 10
     return total, max_score
 
-def main():
-    st.set_page_config(page_title="考核系統", layout="wide")
-    
-    init_session_state()
-    check_and_scroll()
-    
-    st.title("✨ 日沐 ‧ 勤美 ‧ 小日子 | 考核系統")
-    
-    sh = connect_to_google_sheets()
-    try:
-        worksheet = sh.worksheet("Assessment_Data")
-    except:
-        worksheet = sh.add_worksheet(title="Assessment_Data", rows=100, cols=100)
-
-    tabs = st.tabs(["1️⃣ 員工自評", "2️⃣ 初考(跟診)", "3️⃣ 初考(櫃檯)", "4️⃣ 覆考(護理長)", "5️⃣ 老闆核決"])
-
-    # ... (Tab 1-4 保持 V30 程式碼不變，為節省篇幅直接引用) ...
-    # 請直接使用上方 V30 的 Tab 1-4 內容，無需修改
-    # 這裡直接從 Tab 5 開始修改
-    
-    # ==========================================
-    # Tab 1: 員工自評
-    # ==========================================
-    with tabs[0]:
-        if st.session_state.submitted_self:
-            show_completion_screen("自評已提交", "資料已傳送給下一關主管。", "btn_back_self")
-        else:
-            st.header("📝 員工自評區")
-            add_security_watermark("員工考核中")
-            show_guidelines()
-            
-            col1, col2, col3, col4 = st.columns(4)
-            with col1: 
-                name = st.text_input("姓名", placeholder="請輸入姓名", key=f"name_{st.session_state.key_counter_self}")
-            
-            with col2: 
-                role = st.selectbox("您的職務身份", ["一般員工", "主管", "護理長"], key=f"role_{st.session_state.key_counter_self}")
-            
-            with col3:
-                primary_group = None
-                if role == "一般員工":
-                    primary_group = st.selectbox("上呈初考主管", ["跟診主管", "櫃檯主管"], help="請選擇負責考核您的直屬主管", key=f"pg_{st.session_state.key_counter_self}")
-                else:
-                    st.write("") 
-                    st.info("✅ 此職務免填初考主管")
+# --- 8. 各分頁內容 (fragment：分頁內的操作只重跑該分頁) ---
+# ==========================================
+# Tab 1: 員工自評
+# ==========================================
+@st.fragment
+def render_self_eval_tab(worksheet):
+    if st.session_state.submitted_self:
+        show_completion_screen("自評已提交", "資料已傳送給下一關主管。", "btn_back_self")
+    else:
+        st.header("📝 員工自評區")
+        add_security_watermark("員工考核中")
+        
+        col1, col2, col3, col4 = st.columns(4)
+        with col1: 
+            name = st.text_input("姓名", placeholder="請輸入姓名", key=f"name_{st.session_state.key_counter_self}")
+        
+        with col2: 
+            role = st.selectbox("您的職務身份", ["一般員工", "主管", "護理長"], key=f"role_{st.session_state.key_counter_self}")
+        
+        with col3:
+            primary_group = None
+            if role == "一般員工":
+                primary_group = st.selectbox("上呈初考主管", ["跟診主管", "櫃檯主管"], help="請選擇負責考核您的直屬主管", key=f"pg_{st.session_state.key_counter_self}")
+            else:
+                st.write("") 
+                st.info("✅ 此職務免填初考主管")
+        
+        with col4: 
+            assess_date = st.date_input("評量日期", date.today(), key=f"date_{st.session_state.key_counter_self}")
+
+        with st.form(key=f"form_self_{st.session_state.key_counter_self}"):
+            if role == "一般員工": 
+                next_status = "待初考"
+            elif role == "主管": 
+                next_status = "待覆考"
+            else: 
+                next_status = "待核決"
+
+            user_scores = render_assessment_in_form("self", st.session_state.key_counter_self, is_self_eval=True)
+            self_comment = st.text_area("自評文字", placeholder="請輸入...")
             
-            with col4: 
-                assess_date = st.date_input("評量日期", date.today(), key=f"date_{st.session_state.key_counter_self}")
-
-            with st.form(key=f"form_self_{st.session_state.key_counter_self}"):
-                if role == "一般員工": 
-                    next_status = "待初考"
-                elif role == "主管": 
-                    next_status = "待覆考"
-                else: 
-                    next_status = "待核決"
-
-                user_scores = render_assessment_in_form("self", st.session_state.key_counter_self, is_self_eval=True)
-                self_comment = st.text_area("自評文字", placeholder="請輸入...")
-                
-                submitted = st.form_submit_button("🚀 送出自評", type="primary")
-
-            if submitted:
-                if not name:
-                    st.error("請填寫姓名")
-                else:
-                    with st.spinner("資料傳送中..."):
-                        load_data_from_sheet.clear()
-                        total_score, max_score = safe_sum_scores_from_dict(user_scores)
-                        
-                        if primary_group:
-                            group_val = "跟診" if primary_group == "跟診主管" else "櫃檯"
-                        else:
-                            group_val = "免初考"
-
-                        data_to_save = {
-                            "目前狀態": next_status,
-                            "初考組別": group_val,
-                            "姓名": name,
-                            "職務身份": role,
-                            "日期": assess_date.strftime("%Y-%m-%d"),
-                            "自評總分": total_score,
-                            "初考總分": 0, "覆考總分": 0, "最終總分": 0,
-                            "自評文字": self_comment,
-                            "初考評語": "", "覆考評語": "", "最終建議": "",
-                            "填寫時間": pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S")
-                        }
-
-                        for item_name, score in user_scores.items():
-                            data_to_save[f"{item_name}-自評"] = score
-                            data_to_save[f"{item_name}-初考"] = 0
-                            data_to_save[f"{item_name}-覆考"] = 0
-                            data_to_save[f"{item_name}-最終"] = 0
-
-                        save_data_using_headers(worksheet, data_to_save)
+            submitted = st.form_submit_button("🚀 送出自評", type="primary")
+
+        if submitted:
+            if not name:
+                st.error("請填寫姓名")
+            else:
+                with st.spinner("資料傳送中..."):
+                    total_score, max_score = safe_sum_scores_from_dict(user_scores)
+                    
+                    if primary_group:
+                        group_val = "跟診" if primary_group == "跟診主管" else "櫃檯"
+                    else:
+                        group_val = "免初考"
+
+                    data_to_save = {
+                        "目前狀態": next_status,
+                        "初考組別": group_val,
+                        "姓名": name,
+                        "職務身份": role,
+                        "日期": assess_date.strftime("%Y-%m-%d"),
+                        "自評總分": total_score,
+                        "初考總分": 0, "覆考總分": 0, "最終總分": 0,
+                        "自評文字": self_comment,
+                        "初考評語": "", "覆考評語": "", "最終建議": "",
+                        "填寫時間": pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S")
+                    }
+
+                    for item_name, score in user_scores.items():
+                        data_to_save[f"{item_name}-自評"] = score
+                        data_to_save[f"{item_name}-初考"] = 0
+                        data_to_save[f"{item_name}-覆考"] = 0
+                        data_to_save[f"{item_name}-最終"] = 0
+
+                    if save_data_using_headers(worksheet, data_to_save):
+                        clear_data_cache()
                         st.session_state.key_counter_self += 1
                         st.session_state.submitted_self = True
                         st.rerun()
 
-    # ==========================================
-    # Tab 2: 初考主管 (跟診)
-    # ==========================================
-    with tabs[1]:
-        if st.session_state.submitted_clinical:
-            show_completion_screen("初考(跟診)已完成", "所有案件已處理完畢。", "btn_back_clin")
-        else:
-            st.header("🦷 初考主管審核 (跟診組)")
-            add_security_watermark("跟診主管考核")
-            show_guidelines() 
-            pwd_clin = st.text_input("🔒 跟診主管密碼", type="password", key="pwd_clin")
-            
-            if pwd_clin == "1111": 
-                data = load_data_from_sheet(worksheet)
-                df_all = pd.DataFrame(data)
-
-                if not df_all.empty and "目前狀態" in df_all.columns and "初考組別" in df_all.columns:
-                    pending_df = df_all[
-                        (df_all["目前狀態"] == "待初考") & 
-                        (df_all["初考組別"] == "跟診")
-                    ]
+# ==========================================
+# Tab 2 / 3: 初考主管 (跟診 / 櫃檯)
+# ==========================================
+# 兩組初考流程相同，只差在組別、密碼設定與各元件的 key
+PRIMARY_REVIEW_GROUPS = {
+    "跟診": {
+        "icon": "🦷", "prefix": "clin", "password_key": "clinical",
+        "counter": "key_counter_clinical", "submitted": "submitted_clinical",
+    },
+    "櫃檯": {
+        "icon": "🖥️", "prefix": "front", "password_key": "front",
+        "counter": "key_counter_front", "submitted": "submitted_front",
+    },
+}
+
+@st.fragment
+def render_primary_review_tab(worksheet, group):
+    spec = PRIMARY_REVIEW_GROUPS[group]
+    prefix = spec["prefix"]
+    counter = st.session_state[spec["counter"]]
+    if st.session_state[spec["submitted"]]:
+        show_completion_screen(f"初考({group})已完成", "所有案件已處理完畢。", f"btn_back_{prefix}")
+    else:
+        st.header(f"{spec['icon']} 初考主管審核 ({group}組)")
+        add_security_watermark(f"{group}主管考核")
+        pwd = st.text_input(f"🔒 {group}主管密碼", type="password", key=f"pwd_{prefix}",
+                            on_change=reset_password_check, args=(spec["password_key"],))
+        
+        if check_password(pwd, spec["password_key"]): 
+            df_all = get_df_all(worksheet)
+
+            if not df_all.empty and "目前狀態" in df_all.columns and "初考組別" in df_all.columns:
+                pending_df = df_all[
+                    (df_all["目前狀態"] == "待初考") & 
+                    (df_all["初考組別"] == group)
+                ]
+                
+                if pending_df.empty:
+                    st.info(f"🎉 目前沒有待審核的{group}組案件。")
+                else:
+                    names = pending_df["姓名"].astype(str)
+                    target_options = (names + " (" + pending_df["日期"].astype(str) + ")").tolist()
+                    choice = st.selectbox("請選擇審核對象", range(len(target_options)), format_func=lambda i: target_options[i], key=f"sel_{prefix}")
+                    target_name = names.iloc[choice]
+                    record = pending_df.iloc[choice]
+
+                    st.markdown("---")
+                    st.subheader(f"正在審核：{target_name}")
                     
-                    if pending_df.empty:
-                        st.info("🎉 目前沒有待審核的跟診組案件。")
-                    else:
-                        target_options = [f"{row['姓名']} ({row['日期']})" for i, row in pending_df.iterrows()]
-                        selected_target = st.selectbox("請選擇審核對象", target_options, key="sel_clin")
-                        
-                        target_name = selected_target.split(" (")[0]
-                        target_date = selected_target.split(" (")[1].replace(")", "")
-                        record = pending_df[(pending_df["姓名"] == target_name) & (pending_df["日期"] == target_date)].iloc[0]
-
-                        st.markdown("---")
-                        st.subheader(f"正在審核：{target_name}")
-                        
-                        real_self_score, self_max = calculate_dynamic_score(record, '-自評', '-自評')
-                        st.write(f"**員工自評總分**：{real_self_score} / {self_max}")
-                        st.info(f"🗨️ **員工自評內容**：{record.get('自評文字', '')}")
-
-                        with st.form(key=f"form_clin_{st.session_state.key_counter_clinical}"):
-                            manager_scores = render_assessment_in_form(
-                                "clin", 
-                                st.session_state.key_counter_clinical,
-                                record=record,
-                                readonly_stages=["-自評"],
-                                is_self_eval=False
-                            )
-                            c1, c2 = st.columns(2)
-                            with c1: manager_name = st.text_input("初考主管簽名")
-                            with c2: manager_comment = st.text_area("初考評語")
-                            submitted_clin = st.form_submit_button("✅ 提交初考", type="primary")
-                        
-                        if submitted_clin:
-                            if not manager_name:
-                                st.error("請簽名！")
-                            else:
-                                with st.spinner("更新資料庫中..."):
-                                    load_data_from_sheet.clear()
-                                    row_idx, debug_df = find_row_index(data, target_name, target_date)
+                    real_self_score, self_max = calculate_dynamic_score(record, '-自評', '-自評')
+                    st.write(f"**員工自評總分**：{real_self_score} / {self_max}")
+                    st.info(f"🗨️ **員工自評內容**：{record.get('自評文字', '')}")
+
+                    with st.form(key=f"form_{prefix}_{counter}"):
+                        manager_scores = render_assessment_in_form(
+                            prefix, 
+                            counter,
+                            record=record,
+                            readonly_stages=["-自評"],
+                            is_self_eval=False
+                        )
+                        c1, c2 = st.columns(2)
+                        with c1: manager_name = st.text_input("初考主管簽名")
+                        with c2: manager_comment = st.text_area("初考評語")
+                        submitted = st.form_submit_button("✅ 提交初考", type="primary")
+                    
+                    if submitted:
+                        if not manager_name:
+                            st.error("請簽名！")
+                        else:
+                            with st.spinner("更新資料庫中..."):
+                                if apply_reviewer_update(
+                                    worksheet, int(record.name) + 2, "待覆考", "初考總分", "-初考", manager_scores,
+                                    {"初考評語": manager_comment}, optional_cells={"初考主管": manager_name},
+                                ):
+                                    df_fresh = get_df_all(worksheet)
+                                    remaining = df_fresh[
+                                        (df_fresh["目前狀態"] == "待初考") & 
+                                        (df_fresh["初考組別"] == group)
+                                    ]
                                     
-                                    if row_idx:
-                                        headers = list(data[0].keys())
-                                        clean_headers = [h.strip() for h in headers]
-                                        updates = []
-                                        try:
-                                            status_col = clean_headers.index("目前狀態") + 1
-                                            updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, status_col), "values": [["待覆考"]]})
-                                            
-                                            total_score, max_score = safe_sum_scores_from_dict(manager_scores)
-                                            score_sum_col = clean_headers.index("初考總分") + 1
-                                            updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, score_sum_col), "values": [[total_score]]})
-
-                                            comment_col = clean_headers.index("初考評語") + 1
-                                            updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, comment_col), "values": [[manager_comment]]})
-                                            
-                                            if "初考主管" in clean_headers:
-                                                manager_col = clean_headers.index("初考主管") + 1
-                                                updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, manager_col), "values": [[manager_name]]})
-
-                                            for item_name, score in manager_scores.items():
-                                                col_name = f"{item_name}-初考"
-                                                if col_name in clean_headers:
-                                                    col_idx = clean_headers.index(col_name) + 1
-                                                    updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, col_idx), "values": [[score]]})
-                                            
-                                            safe_batch_update(worksheet, updates)
-                                            
-                                            load_data_from_sheet.clear()
-                                            fresh_data = load_data_from_sheet(worksheet)
-                                            df_fresh = pd.DataFrame(fresh_data)
-                                            remaining = df_fresh[
-                                                (df_fresh["目前狀態"] == "待初考") & 
-                                                (df_fresh["初考組別"] == "跟診")
-                                            ]
-                                            
-                                            st.session_state.key_counter_clinical += 1
-                                            
-                                            if remaining.empty:
-                                                st.session_state.submitted_clinical = True 
-                                            else:
-                                                st.toast(f"✅ {target_name} 評核完成！已自動載入下一筆。", icon="🎉")
-                                                st.session_state.need_scroll = True
-                                            
-                                            time.sleep(1)
-                                            st.rerun()
-                                            
-                                        except ValueError as e:
-                                            st.error(f"欄位錯誤: {e}")
+                                    st.session_state[spec["counter"]] += 1
+                                    
+                                    if remaining.empty:
+                                        st.session_state[spec["submitted"]] = True
                                     else:
-                                        st.error("❌ 找不到資料。")
+                                        st.toast(f"✅ {target_name} 評核完成！已自動載入下一筆。", icon="🎉")
+                                        st.session_state.need_scroll = True
+                                    
+                                    time.sleep(1)
+                                    st.rerun()
+
+
+# ==========================================
+# Tab 4: 覆考主管 (護理長)
+# ==========================================
+@st.fragment
+def render_secondary_tab(worksheet):
+    if st.session_state.submitted_sec:
+        show_completion_screen("覆考已完成", "案件已移交給老闆核決。", "btn_back_sec")
+    else:
+        st.header("👩‍⚕️ 護理長 (覆考主管) 審核區")
+        add_security_watermark("護理長考核")
+        pwd2 = st.text_input("🔒 護理長密碼", type="password", key="pwd_secondary",
+                             on_change=reset_password_check, args=("secondary",))
+
+        if check_password(pwd2, "secondary"): 
+            df_all = get_df_all(worksheet)
 
-    # ==========================================
-    # Tab 3: 初考主管 (櫃檯)
-    # ==========================================
-    with tabs[2]:
-        if st.session_state.submitted_front:
-            show_completion_screen("初考(櫃檯)已完成", "所有案件已處理完畢。", "btn_back_front")
-        else:
-            st.header("🖥️ 初考主管審核 (櫃檯組)")
-            add_security_watermark("櫃檯主管考核")
-            show_guidelines()
-            pwd_front = st.text_input("🔒 櫃檯主管密碼", type="password", key="pwd_front")
-            
-            if pwd_front == "3333": 
-                data = load_data_from_sheet(worksheet)
-                df_all = pd.DataFrame(data)
-
-                if not df_all.empty and "目前狀態" in df_all.columns and "初考組別" in df_all.columns:
-                    pending_df = df_all[
-                        (df_all["目前狀態"] == "待初考") & 
-                        (df_all["初考組別"] == "櫃檯")
-                    ]
+            if not df_all.empty and "目前狀態" in df_all.columns:
+                pending_df = df_all[df_all["目前狀態"] == "待覆考"]
+                if pending_df.empty:
+                    st.info("🎉 目前沒有待審核的覆考案件。")
+                else:
+                    names = pending_df["姓名"].astype(str)
+                    target_options = (names + " (" + pending_df["日期"].astype(str) + ")").tolist()
+                    choice = st.selectbox("請選擇審核對象", range(len(target_options)), format_func=lambda i: target_options[i], key="sel_secondary")
+                    target_name = names.iloc[choice]
+                    record = pending_df.iloc[choice]
+
+                    st.markdown("---")
+                    user_role = record.get('職務身份', '一般員工')
+                    st.subheader(f"正在審核：{target_name} ({user_role})")
                     
-                    if pending_df.empty:
-                        st.info("🎉 目前沒有待審核的櫃檯組案件。")
+                    (real_self, self_max), (real_prim, prim_max) = calculate_stage_scores(record, ('-自評', '-初考'))
+                    
+                    c1, c2 = st.columns(2)
+                    c1.info(f"**自評總分**：{real_self} / {self_max}\n\n💬 {record.get('自評文字', '')}")
+                    
+                    if record.get("初考組別", "") != "免初考" and real_prim > 0:
+                        c2.warning(f"**初考總分**：{real_prim} / {prim_max}\n\n💬 {record.get('初考評語', '')}\n\n👮‍♂️ 簽名：{record.get('初考主管', '')}")
                     else:
-                        target_options = [f"{row['姓名']} ({row['日期']})" for i, row in pending_df.iterrows()]
-                        selected_target = st.selectbox("請選擇審核對象", target_options, key="sel_front")
-                        
-                        target_name = selected_target.split(" (")[0]
-                        target_date = selected_target.split(" (")[1].replace(")", "")
-                        record = pending_df[(pending_df["姓名"] == target_name) & (pending_df["日期"] == target_date)].iloc[0]
-
-                        st.markdown("---")
-                        st.subheader(f"正在審核：{target_name}")
-                        
-                        real_self_score, self_max = calculate_dynamic_score(record, '-自評', '-自評')
-                        st.write(f"**員工自評總分**：{real_self_score} / {self_max}")
-                        st.info(f"🗨️ **員工自評內容**：{record.get('自評文字', '')}")
-
-                        with st.form(key=f"form_front_{st.session_state.key_counter_front}"):
-                            manager_scores = render_assessment_in_form(
-                                "front", 
-                                st.session_state.key_counter_front,
-                                record=record,
-                                readonly_stages=["-自評"],
-                                is_self_eval=False
-                            )
-                            c1, c2 = st.columns(2)
-                            with c1: manager_name = st.text_input("初考主管簽名")
-                            with c2: manager_comment = st.text_area("初考評語")
-                            submitted_front = st.form_submit_button("✅ 提交初考", type="primary")
-                        
-                        if submitted_front:
-                            if not manager_name:
-                                st.error("請簽名！")
-                            else:
-                                with st.spinner("更新資料庫中..."):
-                                    load_data_from_sheet.clear()
-                                    row_idx, debug_df = find_row_index(data, target_name, target_date)
+                        c2.warning("*(本案件為主管職或免初考，無初考紀錄)*")
+
+                    with st.form(key=f"form_sec_{st.session_state.key_counter_sec}"):
+                        stages_to_show = ["-自評"]
+                        if record.get("初考組別", "") != "免初考":
+                            stages_to_show.append("-初考")
+
+                        manager_scores = render_assessment_in_form(
+                            "secondary", 
+                            st.session_state.key_counter_sec,
+                            record=record,
+                            readonly_stages=stages_to_show,
+                            is_self_eval=False
+                        )
+                        c1, c2 = st.columns(2)
+                        with c1: sec_name = st.text_input("護理長 (覆考主管) 簽名")
+                        with c2: sec_comment = st.text_area("覆考評語")
+                        submitted_sec = st.form_submit_button("✅ 提交覆考", type="primary")
+                    
+                    if submitted_sec:
+                        if not sec_name:
+                            st.error("請簽名！")
+                        else:
+                            with st.spinner("更新資料庫中..."):
+                                if apply_reviewer_update(
+                                    worksheet, int(record.name) + 2, "待核決", "覆考總分", "-覆考", manager_scores,
+                                    {"覆考評語": sec_comment}, optional_cells={"覆考主管": sec_name},
+                                ):
+                                    df_fresh = get_df_all(worksheet)
+                                    remaining = df_fresh[df_fresh["目前狀態"] == "待覆考"]
                                     
-                                    if row_idx:
-                                        headers = list(data[0].keys())
-                                        clean_headers = [h.strip() for h in headers]
-                                        updates = []
-                                        try:
-                                            status_col = clean_headers.index("目前狀態") + 1
-                                            updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, status_col), "values": [["待覆考"]]})
-                                            
-                                            total_score, max_score = safe_sum_scores_from_dict(manager_scores)
-                                            score_sum_col = clean_headers.index("初考總分") + 1
-                                            updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, score_sum_col), "values": [[total_score]]})
-
-                                            comment_col = clean_headers.index("初考評語") + 1
-                                            updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, comment_col), "values": [[manager_comment]]})
-                                            
-                                            if "初考主管" in clean_headers:
-                                                manager_col = clean_headers.index("初考主管") + 1
-                                                updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, manager_col), "values": [[manager_name]]})
-
-                                            for item_name, score in manager_scores.items():
-                                                col_name = f"{item_name}-初考"
-                                                if col_name in clean_headers:
-                                                    col_idx = clean_headers.index(col_name) + 1
-                                                    updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, col_idx), "values": [[score]]})
-                                            
-                                            safe_batch_update(worksheet, updates)
-                                            
-                                            load_data_from_sheet.clear()
-                                            fresh_data = load_data_from_sheet(worksheet)
-                                            df_fresh = pd.DataFrame(fresh_data)
-                                            remaining = df_fresh[
-                                                (df_fresh["目前狀態"] == "待初考") & 
-                                                (df_fresh["初考組別"] == "櫃檯")
-                                            ]
-                                            
-                                            st.session_state.key_counter_front += 1
-                                            
-                                            if remaining.empty:
-                                                st.session_state.submitted_front = True
-                                            else:
-                                                st.toast(f"✅ {target_name} 評核完成！已自動載入下一筆。", icon="🎉")
-                                                st.session_state.need_scroll = True
-                                            
-                                            time.sleep(1)
-                                            st.rerun()
-                                            
-                                        except ValueError as e:
-                                            st.error(f"欄位錯誤: {e}")
+                                    st.session_state.key_counter_sec += 1
+                                    
+                                    if remaining.empty:
+                                        st.session_state.submitted_sec = True
                                     else:
-                                        st.error("❌ 找不到資料。")
-
-    # ==========================================
-    # Tab 4: 覆考主管 (護理長)
-    # ==========================================
-    with tabs[3]:
-        if st.session_state.submitted_sec:
-            show_completion_screen("覆考已完成", "案件已移交給老闆核決。", "btn_back_sec")
-        else:
-            st.header("👩‍⚕️ 護理長 (覆考主管) 審核區")
-            add_security_watermark("護理長考核")
-            show_guidelines()
-            pwd2 = st.text_input("🔒 護理長密碼", type="password", key="pwd_secondary")
-
-            if pwd2 == "2222": 
-                data = load_data_from_sheet(worksheet)
-                df_all = pd.DataFrame(data)
-
-                if not df_all.empty and "目前狀態" in df_all.columns:
-                    pending_df = df_all[df_all["目前狀態"] == "待覆考"]
-                    if pending_df.empty:
-                        st.info("🎉 目前沒有待審核的覆考案件。")
+                                        st.toast(f"✅ {target_name} 評核完成！已自動載入下一筆。", icon="🎉")
+                                        st.session_state.need_scroll = True
+                                    
+                                    time.sleep(1)
+                                    st.rerun()
+
+# ==========================================
+# Tab 5: 老闆最終核決
+# ==========================================
+@st.fragment
+def render_boss_tab(worksheet):
+    # 剛歸檔完先顯示完成畫面，不重新讀取整張表
+    if st.session_state.submitted_boss:
+        st.balloons()
+        show_completion_screen("核決已完成", "本案已歸檔，考核流程圓滿結束。", "btn_back_boss")
+        return
+
+    st.header("🏆 老闆核決區")
+    add_security_watermark("老闆核決中")
+    pwd3 = st.text_input("🔒 老闆密碼", type="password", key="pwd_boss",
+                         on_change=reset_password_check, args=("boss",))
+
+    if check_password(pwd3, "boss"): 
+        ensure_final_grade_column(worksheet)
+        df_all = get_df_all(worksheet)
+        view_mode = st.radio("檢視模式", ["待核決案件", "歷史已完成案件", "📊 全診所總覽"], horizontal=True)
+
+        if not df_all.empty and "目前狀態" in df_all.columns:
+            
+            # --- Mode A: 全診所總覽 (邏輯分流，解決跳掉問題) ---
+            if view_mode == "📊 全診所總覽":
+                if not PLOTLY_AVAILABLE:
+                    st.error("⚠️ 系統尚未安裝 `plotly`，無法顯示圖表。請聯絡管理員新增 `requirements.txt`。")
+                else:
+                    st.markdown("### 🏥 診所戰力儀表板")
+                    
+                    completed_df = df_all[df_all["目前狀態"] == "已完成"].copy()
+                    
+                    if completed_df.empty:
+                        st.info("目前尚無已完成的考核資料，無法分析。")
                     else:
-                        target_options = [f"{row['姓名']} ({row['日期']})" for i, row in pending_df.iterrows()]
-                        selected_target = st.selectbox("請選擇審核對象", target_options, key="sel_secondary")
-                        
-                        target_name = selected_target.split(" (")[0]
-                        target_date = selected_target.split(" (")[1].replace(")", "")
-                        record = pending_df[(pending_df["姓名"] == target_name) & (pending_df["日期"] == target_date)].iloc[0]
-
-                        st.markdown("---")
-                        user_role = record.get('職務身份', '一般員工')
-                        st.subheader(f"正在審核：{target_name} ({user_role})")
-                        
-                        real_self, self_max = calculate_dynamic_score(record, '-自評', '-自評')
-                        real_prim, prim_max = calculate_dynamic_score(record, '-初考', '-自評')
-                        
-                        c1, c2 = st.columns(2)
-                        c1.info(f"**自評總分**：{real_self} / {self_max}\n\n💬 {record.get('自評文字', '')}")
-                        
-                        if record.get("初考組別", "") != "免初考" and real_prim > 0:
-                            c2.warning(f"**初考總分**：{real_prim} / {prim_max}\n\n💬 {record.get('初考評語', '')}\n\n👮‍♂️ 簽名：{record.get('初考主管', '')}")
-                        else:
-                            c2.warning("*(本案件為主管職或免初考，無初考紀錄)*")
-
-                        with st.form(key=f"form_sec_{st.session_state.key_counter_sec}"):
-                            stages_to_show = ["-自評"]
-                            if record.get("初考組別", "") != "免初考":
-                                stages_to_show.append("-初考")
-
-                            manager_scores = render_assessment_in_form(
-                                "secondary", 
-                                st.session_state.key_counter_sec,
-                                record=record,
-                                readonly_stages=stages_to_show,
-                                is_self_eval=False
-                            )
-                            c1, c2 = st.columns(2)
-                            with c1: sec_name = st.text_input("護理長 (覆考主管) 簽名")
-                            with c2: sec_comment = st.text_area("覆考評語")
-                            submitted_sec = st.form_submit_button("✅ 提交覆考", type="primary")
-                        
-                        if submitted_sec:
-                            if not sec_name:
-                                st.error("請簽名！")
+                        try:
+                            avg_score = completed_df["最終總分"].fillna(0).mean()
+                            
+                            st.markdown("#### 本季全診所平均分數")
+                            delta_color = "normal"
+                            if avg_score < 80:
+                                delta_color = "inverse"
+                                st.error(f"⚠️ 平均分數 {avg_score:.1f} 低於 80 分，請注意！")
                             else:
-                                with st.spinner("更新資料庫中..."):
-                                    load_data_from_sheet.clear()
-                                    row_idx, debug_df = find_row_index(data, target_name, target_date)
-                                    if row_idx:
-                                        headers = list(data[0].keys())
-                                        clean_headers = [h.strip() for h in headers]
-                                        updates = []
-                                        try:
-                                            status_col = clean_headers.index("目前狀態") + 1
-                                            updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, status_col), "values": [["待核決"]]})
-                                            
-                                            total_score, max_score = safe_sum_scores_from_dict(manager_scores)
-                                            score_sum_col = clean_headers.index("覆考總分") + 1
-                                            updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, score_sum_col), "values": [[total_score]]})
-
-                                            comment_col = clean_headers.index("覆考評語") + 1
-                                            updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, comment_col), "values": [[sec_comment]]})
-
-                                            if "覆考主管" in clean_headers:
-                                                manager_col = clean_headers.index("覆考主管") + 1
-                                                updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, manager_col), "values": [[sec_name]]})
-
-                                            for item_name, score in manager_scores.items():
-                                                col_name = f"{item_name}-覆考"
-                                                if col_name in clean_headers:
-                                                    col_idx = clean_headers.index(col_name) + 1
-                                                    updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, col_idx), "values": [[score]]})
-                                            
-                                            safe_batch_update(worksheet, updates)
-                                            
-                                            load_data_from_sheet.clear()
-                                            fresh_data = load_data_from_sheet(worksheet)
-                                            df_fresh = pd.DataFrame(fresh_data)
-                                            remaining = df_fresh[df_fresh["目前狀態"] == "待覆考"]
-                                            
-                                            st.session_state.key_counter_sec += 1
-                                            
-                                            if remaining.empty:
-                                                st.session_state.submitted_sec = True
-                                            else:
-                                                st.toast(f"✅ {target_name} 評核完成！已自動載入下一筆。", icon="🎉")
-                                                st.session_state.need_scroll = True
-                                            
-                                            time.sleep(1)
-                                            st.rerun()
-                                            
-                                        except ValueError as e:
-                                            st.error(f"欄位錯誤: {e}")
-                                    else:
-                                        st.error("❌ 找不到原始資料列。")
-
-    # ==========================================
-    # Tab 5: 老闆最終核決
-    # ==========================================
-    with tabs[4]:
-        st.header("🏆 老闆核決區")
-        add_security_watermark("老闆核決中")
-        show_guidelines() 
-        pwd3 = st.text_input("🔒 老闆密碼", type="password", key="pwd_boss")
+                                st.success(f"✅ 平均分數 {avg_score:.1f} 表現良好")
+                                
+                            st.metric("平均總分", f"{avg_score:.1f}", delta=f"{avg_score - 80:.1f} (vs 80分)", delta_color=delta_color)
+                            
+                        except Exception as e:
+                            st.error(f"計算平均分時發生錯誤: {e}")
 
-        if pwd3 == "8888": 
-            data = load_data_from_sheet(worksheet)
-            df_all = pd.DataFrame(data)
-            view_mode = st.radio("檢視模式", ["待核決案件", "歷史已完成案件", "📊 全診所總覽"], horizontal=True)
+                        st.markdown("---")
 
-            if not df_all.empty and "目前狀態" in df_all.columns:
-                
-                # --- Mode A: 全診所總覽 (邏輯分流，解決跳掉問題) ---
-                if view_mode == "📊 全診所總覽":
-                    if not PLOTLY_AVAILABLE:
-                        st.error("⚠️ 系統尚未安裝 `plotly`，無法顯示圖表。請聯絡管理員新增 `requirements.txt`。")
-                    else:
-                        st.markdown("### 🏥 診所戰力儀表板")
+                        st.markdown("#### 🎯 各面向能力分佈 (雷達圖)")
                         
-                        completed_df = df_all[df_all["目前狀態"] == "已完成"].copy()
+                        # 各項最終分數整欄轉數值：N/A、空白與無法解析的值變成 NaN 不列入平均；欄位不存在視為 0 分
+                        final_vals = (
+                            completed_df.reindex(columns=STAGE_COLS["-最終"], fill_value=0)
+                            .apply(pd.to_numeric, errors="coerce")
+                            .to_numpy(dtype=float)
+                        )
+                        categories = [item["類別"] for item in get_assessment_items()]
+                        item_cats = np.array(categories)
                         
-                        if completed_df.empty:
-                            st.info("目前尚無已完成的考核資料，無法分析。")
-                        else:
-                            try:
-                                completed_df["最終總分"] = pd.to_numeric(completed_df["最終總分"], errors='coerce').fillna(0)
-                                avg_score = completed_df["最終總分"].mean()
-                                
-                                st.markdown("#### 本季全診所平均分數")
-                                delta_color = "normal"
-                                if avg_score < 80:
-                                    delta_color = "inverse"
-                                    st.error(f"⚠️ 平均分數 {avg_score:.1f} 低於 80 分，請注意！")
-                                else:
-                                    st.success(f"✅ 平均分數 {avg_score:.1f} 表現良好")
-                                    
-                                st.metric("平均總分", f"{avg_score:.1f}", delta=f"{avg_score - 80:.1f} (vs 80分)", delta_color=delta_color)
-                                
-                            except Exception as e:
-                                st.error(f"計算平均分時發生錯誤: {e}")
-
-                            st.markdown("---")
-
-                            st.markdown("#### 🎯 各面向能力分佈 (雷達圖)")
+                        cat_means = {}
+                        for cat in dict.fromkeys(categories):
+                            scores = final_vals[:, item_cats == cat]
+                            scores = scores[~np.isnan(scores)]
+                            cat_means[cat] = scores.mean() if scores.size else 0
+                        
+                        if cat_means:
+                            categories_list = list(cat_means.keys())
+                            values_list = list(cat_means.values())
                             
-                            items = get_assessment_items()
-                            cat_map = {i['考核項目']: i['類別'] for i in items}
-                            categories = list(set(cat_map.values()))
+                            categories_list.append(categories_list[0])
+                            values_list.append(values_list[0])
                             
-                            cat_scores = {cat: [] for cat in categories}
+                            fig = go.Figure()
+                            fig.add_trace(go.Scatterpolar(
+                                r=values_list,
+                                theta=categories_list,
+                                fill='toself',
+                                name='全診所平均'
+                            ))
                             
-                            for _, row in completed_df.iterrows():
-                                for item in items:
-                                    col_name = f"{item['考核項目']}-最終"
-                                    val = row.get(col_name, 0)
-                                    if str(val) != 'N/A' and str(val) != '':
-                                        try:
-                                            cat_scores[cat_map[item['考核項目']]].append(float(val))
-                                        except:
-                                            pass
+                            fig.update_layout(
+                                polar=dict(
+                                    radialaxis=dict(
+                                        visible=True,
+                                        range=[0, 10]
+                                    )),
+                                showlegend=False
+                            )
                             
-                            cat_means = {}
-                            for cat, scores in cat_scores.items():
-                                if scores:
-                                    cat_means[cat] = sum(scores) / len(scores)
-                                else:
-                                    cat_means[cat] = 0
+                            st.plotly_chart(fig, use_container_width=True)
                             
-                            if cat_means:
-                                categories_list = list(cat_means.keys())
-                                values_list = list(cat_means.values())
-                                
-                                categories_list.append(categories_list[0])
-                                values_list.append(values_list[0])
-                                
-                                fig = go.Figure()
-                                fig.add_trace(go.Scatterpolar(
-                                    r=values_list,
-                                    theta=categories_list,
-                                    fill='toself',
-                                    name='全診所平均'
-                                ))
-                                
-                                fig.update_layout(
-                                    polar=dict(
-                                        radialaxis=dict(
-                                            visible=True,
-                                            range=[0, 10]
-                                        )),
-                                    showlegend=False
-                                )
-                                
-                                st.plotly_chart(fig, use_container_width=True)
-                                
-                                weakest_cat = min(cat_means, key=cat_means.get)
-                                strongest_cat = max(cat_means, key=cat_means.get)
-                                st.info(f"💡 分析建議：目前診所優勢在 **【{strongest_cat}】**，但 **【{weakest_cat}】** 相對較弱，建議作為下一季教育訓練重點。")
+                            weakest_cat = min(cat_means, key=cat_means.get)
+                            strongest_cat = max(cat_means, key=cat_means.get)
+                            st.info(f"💡 分析建議：目前診所優勢在 **【{strongest_cat}】**，但 **【{weakest_cat}】** 相對較弱，建議作為下一季教育訓練重點。")
+
+            # --- Mode B & C: 待核決 & 歷史 ---
+            else:
+                if view_mode == "待核決案件":
+                    pending_df = df_all[df_all["目前狀態"] == "待核決"]
+                else:
+                    pending_df = df_all[df_all["目前狀態"] == "已完成"]
 
-                # --- Mode B & C: 待核決 & 歷史 ---
+                if pending_df.empty:
+                    st.info(f"🎉 目前沒有 {view_mode}。")
                 else:
-                    if view_mode == "待核決案件":
-                        pending_df = df_all[df_all["目前狀態"] == "待核決"]
-                    else:
-                        pending_df = df_all[df_all["目前狀態"] == "已完成"]
+                    pending_df = pending_df.sort_values(by="_date", ascending=False, kind="mergesort")
 
+                    if pending_df["_date"].notna().any():
+                        min_date = pending_df["_date"].min().date()
+                        max_date = pending_df["_date"].max().date()
+                        
+                        st.markdown("### 🔍 篩選與選擇")
+                        c1, c2 = st.columns([1, 2])
+                        with c1:
+                            date_range = st.date_input("📅 篩選日期範圍", [min_date, max_date])
+                        
+                        # 範圍仍是全部日期 (且沒有無法解析的日期) 時篩選結果不變，不必再比對
+                        if (isinstance(date_range, (list, tuple)) and len(date_range) == 2
+                                and (tuple(date_range) != (min_date, max_date) or pending_df["_date"].hasnans)):
+                            start_d, end_d = date_range
+                            # 已依日期新→舊排序 (NaT 排最後)，日期範圍就是連續的一段：
+                            # 把有效日期段反轉成舊→新後二分搜尋頭尾 (迄日含當天)，再換算回原位置切片
+                            n_valid = int(pending_df["_date"].notna().sum())
+                            asc_dates = pending_df["_date"].to_numpy()[:n_valid][::-1]
+                            lo = asc_dates.searchsorted(np.datetime64(pd.Timestamp(start_d)), side="left")
+                            hi = asc_dates.searchsorted(np.datetime64(pd.Timestamp(end_d) + pd.Timedelta(days=1)), side="left")
+                            pending_df = pending_df.iloc[n_valid - hi:n_valid - lo]
+                    
                     if pending_df.empty:
-                        st.info(f"🎉 目前沒有 {view_mode}。")
+                        st.warning("⚠️ 此日期範圍內無資料。")
                     else:
-                        pending_df["dt_obj"] = pd.to_datetime(pending_df["日期"], errors='coerce').dt.date
-                        pending_df = pending_df.sort_values(by="dt_obj", ascending=False)
+                        names = pending_df["姓名"].astype(str)
+                        target_options = (names + " (" + pending_df["日期"].astype(str) + ")").tolist()
+                        choice = st.selectbox("請選擇對象", range(len(target_options)), format_func=lambda i: target_options[i], key="sel_boss")
+                        target_name = names.iloc[choice]
+                        record = pending_df.iloc[choice]
+
+                        # 歷史趨勢圖
+                        if view_mode == "歷史已完成案件" and PLOTLY_AVAILABLE:
+                            st.markdown("### 📈 該員工歷史成績趨勢")
+                            history_rows = get_history_rows(worksheet).get(target_name, [])
+                            if history_rows:
+                                # 只取圖表需要的兩欄，不複製整列
+                                chart_data = df_all.loc[history_rows, ["_date", "最終總分"]].set_index("_date").rename_axis("日期")
+                                st.line_chart(chart_data)
 
-                        if not pending_df["dt_obj"].dropna().empty:
-                            min_date = pending_df["dt_obj"].min()
-                            max_date = pending_df["dt_obj"].max()
-                            
-                            st.markdown("### 🔍 篩選與選擇")
-                            c1, c2 = st.columns([1, 2])
-                            with c1:
-                                date_range = st.date_input("📅 篩選日期範圍", [min_date, max_date])
-                            
-                            if isinstance(date_range, (list, tuple)) and len(date_range) == 2:
-                                start_d, end_d = date_range
-                                pending_df = pending_df[
-                                    (pending_df["dt_obj"] >= start_d) & 
-                                    (pending_df["dt_obj"] <= end_d)
-                                ]
+                        st.markdown("---")
                         
-                        if pending_df.empty:
-                            st.warning("⚠️ 此日期範圍內無資料。")
+                        # [V32 修正] 標題邏輯優化
+                        user_role = record.get('職務身份', '一般員工')
+                        if view_mode == "待核決案件":
+                            st.header(f"👑 正在核決：{target_name} ({user_role})")
                         else:
-                            target_options = [f"{row['姓名']} ({row['日期']})" for i, row in pending_df.iterrows()]
-                            selected_target = st.selectbox("請選擇對象", target_options, key="sel_boss")
-                            
-                            target_name = selected_target.split(" (")[0]
-                            target_date_str = selected_target.split(" (")[1].replace(")", "")
-                            record = pending_df[(pending_df["姓名"] == target_name) & (pending_df["日期"] == target_date_str)].iloc[0]
-
-                            # 歷史趨勢圖
-                            if view_mode == "歷史已完成案件" and PLOTLY_AVAILABLE:
-                                st.markdown("### 📈 該員工歷史成績趨勢")
-                                history_df = df_all[df_all["姓名"] == target_name].copy()
-                                history_df["dt_obj"] = pd.to_datetime(history_df["日期"], errors='coerce')
-                                history_df = history_df.sort_values("dt_obj") 
-                                if not history_df.empty:
-                                    chart_data = history_df[["dt_obj", "最終總分"]].set_index("dt_obj")
-                                    st.line_chart(chart_data)
-
-                            st.markdown("---")
-                            
-                            # [V32 修正] 標題邏輯優化
-                            user_role = record.get('職務身份', '一般員工')
-                            if view_mode == "待核決案件":
-                                st.header(f"👑 正在核決：{target_name} ({user_role})")
+                            st.header(f"✅ 已完成考核：{target_name} ({user_role})")
+
+                        st.markdown("### 📝 各階段評語紀錄")
+                        c1, c2, c3 = st.columns(3)
+                        with c1:
+                            st.info(f"**🗣️ 員工自評**\n\n{record.get('自評文字', '無')}")
+                        with c2:
+                            if record.get("初考組別", "") == "免初考":
+                                st.warning("**⚠️ 此員工免初考**")
                             else:
-                                st.header(f"✅ 已完成考核：{target_name} ({user_role})")
-
-                            st.markdown("### 📝 各階段評語紀錄")
-                            c1, c2, c3 = st.columns(3)
-                            with c1:
-                                st.info(f"**🗣️ 員工自評**\n\n{record.get('自評文字', '無')}")
-                            with c2:
-                                if record.get("初考組別", "") == "免初考":
-                                    st.warning("**⚠️ 此員工免初考**")
-                                else:
-                                    st.warning(f"**👮‍♂️ 初考評語**\n\n{record.get('初考評語', '無')}\n\n(簽名: {record.get('初考主管', '')})")
-                            with c3:
-                                st.error(f"**👩‍⚕️ 覆考評語**\n\n{record.get('覆考評語', '無')}\n\n(簽名: {record.get('覆考主管', '')})")
-
-                            st.markdown("---")
-                            
-                            real_self, s_max = calculate_dynamic_score(record, '-自評', '-自評')
-                            real_prim, p_max = calculate_dynamic_score(record, '-初考', '-自評')
-                            real_sec, sec_max = calculate_dynamic_score(record, '-覆考', '-自評')
-                            real_final, f_max = calculate_dynamic_score(record, '-最終', '-自評')
+                                st.warning(f"**👮‍♂️ 初考評語**\n\n{record.get('初考評語', '無')}\n\n(簽名: {record.get('初考主管', '')})")
+                        with c3:
+                            st.error(f"**👩‍⚕️ 覆考評語**\n\n{record.get('覆考評語', '無')}\n\n(簽名: {record.get('覆考主管', '')})")
 
-                            col1, col2, col3, col4 = st.columns(4)
-                            col1.metric("自評總分", f"{real_self} / {s_max}")
+                        st.markdown("---")
+                        
+                        (real_self, s_max), (real_prim, p_max), (real_sec, sec_max), (real_final, f_max) = (
+                            calculate_stage_scores(record, ('-自評', '-初考', '-覆考', '-最終'))
+                        )
+
+                        col1, col2, col3, col4 = st.columns(4)
+                        col1.metric("自評總分", f"{real_self} / {s_max}")
+                        
+                        if record.get("初考組別", "") == "免初考":
+                            col2.metric("初考總分", "免初考")
+                        else:
+                            col2.metric("初考總分", f"{real_prim} / {p_max}")
                             
+                        col3.metric("覆考總分", f"{real_sec} / {sec_max}")
+                        
+                        if view_mode == "歷史已完成案件":
+                            col4.metric("🏆 最終總分", f"{real_final} / {f_max}")
+                            st.success(f"📌 最終建議：{record.get('最終建議', '')}")
+                            st.success(f"🏅 最終考績：{record.get('最終考績', '未評定')}")
+                            
+                            csv = to_csv_bytes(pending_df.drop(columns=["_date"]))
+                            st.download_button(
+                                label="📥 下載本頁搜尋結果 (Excel/CSV)",
+                                data=csv,
+                                file_name=f"assessment_export_{date.today()}.csv",
+                                mime="text/csv",
+                            )
+                            
+                            st.markdown("### 詳細成績單")
+                            # 四個階段的分數一次 reindex 取出，再排成 項目×階段；欄位不存在時顯示 "-"
+                            stage_vals = record.reindex(DETAIL_COLS).fillna("-").astype(str).to_numpy()
+                            detail_df = pd.DataFrame(stage_vals.reshape(len(DETAIL_STAGES), len(ITEM_NAMES)).T, columns=DETAIL_STAGES)
+                            detail_df.insert(0, "考核項目", ITEM_NAMES)
                             if record.get("初考組別", "") == "免初考":
-                                col2.metric("初考總分", "免初考")
-                            else:
-                                col2.metric("初考總分", f"{real_prim} / {p_max}")
-                                
-                            col3.metric("覆考總分", f"{real_sec} / {sec_max}")
+                                detail_df["初考"] = "免初考"
+                            st.table(detail_df)
+                        else: 
+                            st.warning("請填寫最終成績與考績以完成考核。")
                             
-                            if view_mode == "歷史已完成案件":
-                                col4.metric("🏆 最終總分", f"{real_final} / {f_max}")
-                                st.success(f"📌 最終建議：{record.get('最終建議', '')}")
-                                st.success(f"🏅 最終考績：{record.get('最終考績', '未評定')}")
+                            with st.form(key=f"form_boss_{st.session_state.key_counter_boss}"):
+                                stages_to_show = ["-自評"]
+                                if record.get("初考組別", "") != "免初考":
+                                    stages_to_show.append("-初考")
+                                stages_to_show.append("-覆考")
+
+                                avg_defaults = calculate_average_defaults(record)
                                 
-                                csv = pending_df.to_csv(index=False).encode('utf-8-sig')
-                                st.download_button(
-                                    label="📥 下載本頁搜尋結果 (Excel/CSV)",
-                                    data=csv,
-                                    file_name=f"assessment_export_{date.today()}.csv",
-                                    mime="text/csv",
+                                boss_scores = render_assessment_in_form(
+                                    "boss", 
+                                    st.session_state.key_counter_boss,
+                                    record=record,
+                                    readonly_stages=stages_to_show,
+                                    is_self_eval=False,
+                                    default_scores=avg_defaults
                                 )
-                                
-                                st.markdown("### 詳細成績單")
-                                items = get_assessment_items()
-                                detail_rows = []
-                                for item in items:
-                                    i_name = item["考核項目"]
-                                    prim_score = "免初考" if record.get("初考組別", "") == "免初考" else str(record.get(f"{i_name}-初考", "-"))
-                                    
-                                    detail_rows.append({
-                                        "考核項目": i_name,
-                                        "自評": str(record.get(f"{i_name}-自評", "-")),
-                                        "初考": prim_score,
-                                        "覆考": str(record.get(f"{i_name}-覆考", "-")),
-                                        "最終": str(record.get(f"{i_name}-最終", "-")),
-                                    })
-                                st.table(pd.DataFrame(detail_rows))
-                            else: 
-                                st.warning("請填寫最終成績與考績以完成考核。")
-                                
-                                with st.form(key=f"form_boss_{st.session_state.key_counter_boss}"):
-                                    stages_to_show = ["-自評"]
-                                    if record.get("初考組別", "") != "免初考":
-                                        stages_to_show.append("-初考")
-                                    stages_to_show.append("-覆考")
+                                c1, c2 = st.columns(2)
+                                with c1: final_action = st.selectbox("最終建議", ["通過", "需觀察", "需輔導", "工作調整", "其他"])
+                                with c2: final_grade = st.selectbox("🏅 最終考績", ["S", "A+", "A", "A-", "B"], index=2)
+                                submitted_boss = st.form_submit_button("🏆 核決並歸檔", type="primary")
+                            
+                            if submitted_boss:
+                                with st.spinner("正在歸檔..."):
+                                    if apply_reviewer_update(
+                                        worksheet, int(record.name) + 2, "已完成", "最終總分", "-最終", boss_scores,
+                                        {"最終建議": final_action, "最終考績": final_grade},
+                                    ):
+                                        st.session_state.key_counter_boss += 1
+                                        st.session_state.submitted_boss = True
+                                        st.session_state.need_scroll = True
+                                        st.rerun()
 
-                                    avg_defaults = calculate_average_defaults(record)
-                                    
-                                    boss_scores = render_assessment_in_form(
-                                        "boss", 
-                                        st.session_state.key_counter_boss,
-                                        record=record,
-                                        readonly_stages=stages_to_show,
-                                        is_self_eval=False,
-                                        default_scores=avg_defaults
-                                    )
-                                    c1, c2 = st.columns(2)
-                                    with c1: final_action = st.selectbox("最終建議", ["通過", "需觀察", "需輔導", "工作調整", "其他"])
-                                    with c2: final_grade = st.selectbox("🏅 最終考績", ["S", "A+", "A", "A-", "B"], index=2)
-                                    submitted_boss = st.form_submit_button("🏆 核決並歸檔", type="primary")
-                                
-                                if submitted_boss:
-                                    with st.spinner("正在歸檔..."):
-                                        load_data_from_sheet.clear()
-                                        row_idx, debug_df = find_row_index(data, target_name, target_date_str)
-                                        if row_idx:
-                                            headers = list(data[0].keys())
-                                            clean_headers = [h.strip() for h in headers]
-                                            updates = []
-                                            try:
-                                                if "最終考績" not in clean_headers:
-                                                    st.toast("正在新增【最終考績】欄位...", icon="🔧")
-                                                    worksheet.update_cell(1, len(clean_headers) + 1, "最終考績")
-                                                    clean_headers.append("最終考績")
-                                                    time.sleep(1)
-
-                                                status_col = clean_headers.index("目前狀態") + 1
-                                                updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, status_col), "values": [["已完成"]]})
-                                                
-                                                total_score, max_score = safe_sum_scores_from_dict(boss_scores)
-                                                score_sum_col = clean_headers.index("最終總分") + 1
-                                                updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, score_sum_col), "values": [[total_score]]})
-
-                                                suggest_col = clean_headers.index("最終建議") + 1
-                                                updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, suggest_col), "values": [[final_action]]})
-                                                
-                                                grade_col = clean_headers.index("最終考績") + 1
-                                                updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, grade_col), "values": [[final_grade]]})
-
-                                                for item_name, score in boss_scores.items():
-                                                    col_name = f"{item_name}-最終"
-                                                    if col_name in clean_headers:
-                                                        col_idx = clean_headers.index(col_name) + 1
-                                                        updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, col_idx), "values": [[score]]})
-                                                
-                                                safe_batch_update(worksheet, updates)
-                                                st.session_state.key_counter_boss += 1
-                                                st.balloons()
-                                                st.success("🎉 考核流程圓滿結束！")
-                                                
-                                                st.session_state.need_scroll = True
-                                                
-                                                time.sleep(1.5)
-                                                st.rerun()
-                                            except ValueError as e:
-                                                st.error(f"欄位錯誤: {e}")
-                                        else:
-                                            st.error("❌ 找不到原始資料列。")
+def main():
+    st.set_page_config(page_title="考核系統", layout="wide")
+    
+    init_session_state()
+    inject_page_styles()
+    check_and_scroll()
+    
+    st.title("✨ 日沐 ‧ 勤美 ‧ 小日子 | 考核系統")
+    
+    sh = connect_to_google_sheets()
+    worksheet = get_worksheet(sh, "Assessment_Data")
+
+    if st.button("🔄 重新整理資料", help="立即重新讀取 Google Sheets 的最新資料"):
+        clear_data_cache()
+
+    # 評分標準各分頁共用，在分頁外顯示一次
+    show_guidelines()
+
+    tabs = st.tabs(["1️⃣ 員工自評", "2️⃣ 初考(跟診)", "3️⃣ 初考(櫃檯)", "4️⃣ 覆考(護理長)", "5️⃣ 老闆核決"])
+
+    # ... (Tab 1-4 保持 V30 程式碼不變，為節省篇幅直接引用) ...
+    # 請直接使用上方 V30 的 Tab 1-4 內容，無需修改
+    # 這裡直接從 Tab 5 開始修改
+
+    with tabs[0]:
+        render_self_eval_tab(worksheet)
+    with tabs[1]:
+        render_primary_review_tab(worksheet, "跟診")
+    with tabs[2]:
+        render_primary_review_tab(worksheet, "櫃檯")
+    with tabs[3]:
+        render_secondary_tab(worksheet)
+    with tabs[4]:
+        render_boss_tab(worksheet)
 
 if __name__ == "__main__":
     main()